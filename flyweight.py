@@ -2,8 +2,29 @@
 # - a fix for a performance problem in Java (not use it unless there is a really critical performance issue)
 # use a centralized collection to reduce memory and creation overhead 
 
+import gc
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import threading
+import time
+import weakref
+from array import array
+from collections import OrderedDict
+from itertools import islice, izip
+
+try:
+    import tracemalloc # optional: measure allocated bytes exactly (python 3)
+except ImportError:
+    tracemalloc = None
+
 class CoffeeFlavor(object):
     # indivisual objects
+    # __slots__ leaves out the per-instance __dict__ (__weakref__ is kept for the 'weak' Menu)
+
+    __slots__ = ('name', '__weakref__')
 
     def __init__(self, newFlavor):
         self.name = newFlavor
@@ -11,24 +32,90 @@ class CoffeeFlavor(object):
     def __str__(self):
         return self.name
 
+class MenuStripe(object):
+    # one lock and the part of the flyweights whose names hash to it, so that threads looking up
+    # different flavors rarely wait for each other
+
+    def __init__(self, eviction, capacity):
+        self.lock = threading.Lock()
+        if eviction == 'weak':
+            self.flavors = weakref.WeakValueDictionary() # released once no order refers to them
+        else:
+            self.flavors = OrderedDict()
+        self.eviction = eviction
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, flavorName):
+        with self.lock:
+            flavor = self.flavors.get(flavorName)
+            if flavor is not None:
+                self.hits += 1
+                if self.eviction == 'lru':
+                    self.flavors[flavorName] = self.flavors.pop(flavorName) # most recently used goes last
+                return flavor
+            self.misses += 1
+            flavor = self.flavors[flavorName] = CoffeeFlavor(flavorName)
+            if self.eviction == 'lru' and len(self.flavors) > self.capacity:
+                self.flavors.popitem(last=False)
+            return flavor
+
 class Menu(object):
     # use a centralized collection to represent coffee flavor objects
     # objects already created will be shared
+    # the collection is split into lock-protected stripes, so that lookup is thread-safe (no duplicate
+    # flavor objects); eviction can be None (keep all), 'weak' (drop unreferenced flavors)
+    # or 'lru' (keep at most capacity flavors, the least recently used being dropped first;
+    # recency and the limit are global, so an lru menu has a single stripe)
+
+    evictions = (None, 'weak', 'lru')
 
-    def __init__(self):
-        self.flavors = dict()
+    def __init__(self, stripes=16, eviction=None, capacity=None):
+        if eviction not in self.evictions:
+            raise ValueError('unknown eviction %r, expected one of %r' % (eviction, self.evictions))
+        if eviction == 'lru':
+            if capacity is None or capacity < 1:
+                raise ValueError('lru eviction needs a capacity of at least 1')
+            stripes = 1
+        self.stripes = [MenuStripe(eviction, capacity) for _ in range(stripes)]
+        self.flavorIds = dict() # flavor name -> stable integer id
+        self.flavorNames = [] # integer id -> flavor name
+        self.idLock = threading.Lock()
 
     def lookup(self, flavorName):
         # create coffee flavor object at run time if not in the centralized collection
-        if flavorName not in self.flavors:
-            self.flavors[flavorName] = CoffeeFlavor(flavorName)
-        return self.flavors[flavorName]
+        return self.stripes[hash(flavorName) % len(self.stripes)].lookup(flavorName)
+
+    def flavorId(self, flavorName):
+        # a small integer standing for the flavor, it stays the same even if the flavor is evicted
+        # ids are never reused, since an OrderBook may still hold them: the id table keeps one name
+        # per distinct flavor ever given an id, whatever the eviction of the flavor objects
+        flavorId = self.flavorIds.get(flavorName)
+        if flavorId is None:
+            with self.idLock:
+                flavorId = self.flavorIds.setdefault(flavorName, len(self.flavorNames))
+                if flavorId == len(self.flavorNames):
+                    self.flavorNames.append(flavorName)
+        return flavorId
+
+    def flavorName(self, flavorId):
+        # the name shared by every order of the flavor; unlike lookup it neither counts a hit
+        # nor brings an evicted flavor back
+        return self.flavorNames[flavorId]
 
     def totalCoffeeFlavorsMade(self):
-        return len(self.flavors)
+        return sum(stripe.misses for stripe in self.stripes)
+
+    def statistics(self):
+        return {'hits': sum(stripe.hits for stripe in self.stripes),
+                'misses': sum(stripe.misses for stripe in self.stripes),
+                'live': sum(len(stripe.flavors) for stripe in self.stripes)}
 
 class Order(object):
 
+    __slots__ = ('tableNumber', 'flavor')
+
     def __init__(self, tableNumber, flavor):
         self.tableNumber = tableNumber
         self.flavor = flavor
@@ -38,9 +125,9 @@ class Order(object):
 
 class CoffeeShop(object):
 
-    def __init__(self):
+    def __init__(self, menu=None):
         self.orders = []
-        self.menu = Menu() # sometimes declared as a static member
+        self.menu = Menu() if menu is None else menu # sometimes declared as a static member
 
     def takeOrder(self, flavorName, tableNumber):
         # if not using flyweight pattern, just create object by CoffeeFlavor(flavorName)
@@ -52,9 +139,208 @@ class CoffeeShop(object):
         for order in self.orders:
             order.serve()
 
+    def serviceBatched(self, output=None, batchSize=10000):
+        # serve the orders batch by batch: each batch is grouped by flavor and rendered into one
+        # string, written with a single call; returns the number of orders served per second
+        output = output or sys.stdout
+        start = time.time()
+        served = 0
+        orders = iter(self.orders)
+        while True:
+            batch = list(islice(orders, batchSize))
+            if not batch:
+                break
+            tablesByFlavor = OrderedDict()
+            for order in batch:
+                tablesByFlavor.setdefault(order.flavor, []).append(order.tableNumber)
+            output.write(''.join('Serving %s to table %s\n' % (flavor, tableNumber)
+                                 for flavor, tableNumbers in tablesByFlavor.items() for tableNumber in tableNumbers))
+            served += len(batch)
+        output.flush()
+        return served / max(time.time() - start, 1e-9)
+
     def report(self):
         return 'Total CoffeeFlavor objects made: %s' % self.menu.totalCoffeeFlavorsMade()
 
+class OrderBook(object):
+    # orders stored column-wise: one typed array of table numbers and one of flavor ids,
+    # instead of one Order object per order
+
+    def __init__(self, menu):
+        self.menu = menu
+        self.tableNumbers = array('l')
+        self.flavorIds = array('l')
+
+    def append(self, flavorName, tableNumber):
+        self.tableNumbers.append(tableNumber)
+        self.flavorIds.append(self.menu.flavorId(flavorName))
+
+    def extend(self, orders):
+        # orders: (flavorName, tableNumber) pairs
+        for flavorName, tableNumber in orders:
+            self.append(flavorName, tableNumber)
+
+    def __len__(self):
+        return len(self.tableNumbers)
+
+    def __iter__(self):
+        # short-lived Order views built from the columns, the flavor being its shared name
+        for tableNumber, flavorId in izip(self.tableNumbers, self.flavorIds):
+            yield Order(tableNumber, self.menu.flavorName(flavorId))
+
+    def byteSize(self):
+        return sum(column.buffer_info()[1] * column.itemsize for column in (self.tableNumbers, self.flavorIds))
+
+class ColumnarCoffeeShop(CoffeeShop):
+
+    def __init__(self, menu=None):
+        super(ColumnarCoffeeShop, self).__init__(menu)
+        self.orders = OrderBook(self.menu)
+
+    def takeOrder(self, flavorName, tableNumber):
+        self.orders.append(flavorName, tableNumber)
+
+    def takeOrders(self, orders):
+        self.orders.extend(orders)
+
+class FrozenMenu(object):
+    # the flavor table of a Menu frozen into a file that every worker process maps read-only,
+    # so the table exists once in memory (the page cache) however many workers there are
+    # ids are the same as in the Menu it came from; each process shares one CoffeeFlavor per id,
+    # made the first time the id is looked up, so the name is read from the table only once
+    # layout: header, name offsets by id, ids sorted by name (for binary search), names
+
+    header = struct.Struct('<4sxxxxq') # magic, number of flavors
+    magic = 'MENU'
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            self.table = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = self.header.unpack_from(self.table, 0)
+        if magic != self.magic:
+            raise ValueError('not a frozen menu')
+        self.offsets = struct.Struct('<%sq' % (self.count + 1))
+        self.sortedIds = struct.Struct('<%sq' % self.count)
+        self.flavors = dict() # flavor id -> CoffeeFlavor, in this process
+        self.flavorIds = dict() # flavor name -> flavor id, for the names looked up so far
+        self.lock = threading.Lock()
+
+    def __reduce__(self):
+        # a spawned worker receives the filename and maps the same file, the mmap is not pickled
+        return (FrozenMenu, (self.filename,))
+
+    @classmethod
+    def freeze(cls, menu, filename):
+        for stripe in menu.stripes:
+            for flavorName in list(stripe.flavors.keys()):
+                menu.flavorId(flavorName) # give every flavor made so far its id
+        names = list(menu.flavorNames)
+        offsets = [0]
+        for name in names:
+            offsets.append(offsets[-1] + len(name))
+        sortedIds = sorted(range(len(names)), key=names.__getitem__)
+        with open(filename, 'wb') as f:
+            f.write(cls.header.pack(cls.magic, len(names)))
+            f.write(struct.pack('<%sq' % len(offsets), *offsets))
+            f.write(struct.pack('<%sq' % len(sortedIds), *sortedIds))
+            f.write(''.join(names))
+        return cls(filename)
+
+    def readFlavorName(self, flavorId):
+        # the name of a flavor, read from the shared table
+        if not 0 <= flavorId < self.count:
+            raise IndexError('flavor id %s out of range' % flavorId)
+        position = self.header.size + 8 * flavorId
+        start, end = struct.unpack_from('<qq', self.table, position)
+        namesStart = self.header.size + self.offsets.size + self.sortedIds.size
+        return self.table[namesStart + start:namesStart + end]
+
+    def lookupById(self, flavorId):
+        flavor = self.flavors.get(flavorId)
+        if flavor is None:
+            flavor = CoffeeFlavor(self.readFlavorName(flavorId))
+            with self.lock:
+                flavor = self.flavors.setdefault(flavorId, flavor)
+        return flavor
+
+    def flavorId(self, flavorName):
+        # the id of a flavor, found by binary search over the names in sorted order
+        flavorId = self.flavorIds.get(flavorName)
+        if flavorId is not None:
+            return flavorId
+        low, high = 0, self.count
+        sortedIdsStart = self.header.size + self.offsets.size
+        while low < high:
+            middle = (low + high) // 2
+            flavorId = struct.unpack_from('<q', self.table, sortedIdsStart + 8 * middle)[0]
+            name = self.readFlavorName(flavorId)
+            if name == flavorName:
+                with self.lock:
+                    self.flavorIds[flavorName] = flavorId
+                return flavorId
+            if name < flavorName:
+                low = middle + 1
+            else:
+                high = middle
+        raise KeyError(flavorName)
+
+    def lookup(self, flavorName):
+        return self.lookupById(self.flavorId(flavorName))
+
+    def flavorName(self, flavorId):
+        return self.lookupById(flavorId).name
+
+    def close(self):
+        self.table.close()
+
+    def totalCoffeeFlavorsMade(self):
+        return self.count
+
+def serveFromFrozenMenu(frozenMenu, orders):
+    workerOrders = OrderBook(frozenMenu)
+    workerOrders.extend(orders)
+    for order in workerOrders:
+        order.serve()
+    sys.stdout.flush()
+
+def residentBytes():
+    # current resident memory of the process, None where it cannot be read (only linux has
+    # /proc/self/statm; the getrusage peak cannot show the growth of a second measurement)
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * mmap.PAGESIZE
+    except IOError:
+        return None
+
+def measureFootprint(factory, count):
+    # create count objects with factory(index) and report the bytes allocated per object, the
+    # objects created per second and how the bytes were measured: by tracemalloc when available,
+    # else by the growth of the resident memory, else by sys.getsizeof of one object and its __dict__
+    gc.collect()
+    objects = [None] * count # allocated before measuring, so only the objects themselves count
+    if tracemalloc is not None:
+        tracemalloc.start()
+    before = residentBytes()
+    start = time.time()
+    for index in xrange(count):
+        objects[index] = factory(index)
+    elapsed = time.time() - start
+    if tracemalloc is not None:
+        method = 'tracemalloc'
+        bytesPerObject = float(tracemalloc.get_traced_memory()[0]) / count
+        tracemalloc.stop()
+    elif before is not None:
+        method = 'resident memory'
+        bytesPerObject = float(residentBytes() - before) / count
+    else:
+        method = 'getsizeof'
+        sample = objects[0]
+        bytesPerObject = sys.getsizeof(sample)
+        if hasattr(sample, '__dict__'):
+            bytesPerObject += sys.getsizeof(sample.__dict__)
+    return {'bytesPerObject': bytesPerObject, 'objectsPerSecond': count / max(elapsed, 1e-9), 'method': method}
+
 shop = CoffeeShop()
 shop.takeOrder("Cappuccino", 2)
 shop.takeOrder("Frappe", 1)
@@ -66,3 +352,67 @@ shop.takeOrder("Espresso", 3)
 shop.takeOrder("Cappuccino", 3)
 shop.service()
 print shop.report()
+print shop.menu.statistics()
+
+lruMenu = Menu(stripes=1, eviction='lru', capacity=2)
+for flavorName in ['Cappuccino', 'Frappe', 'Cappuccino', 'Espresso', 'Frappe']:
+    lruMenu.lookup(flavorName)
+print lruMenu.statistics()
+lruOrders = OrderBook(lruMenu)
+lruOrders.extend([('Cappuccino', 1), ('Espresso', 2)])
+print [str(order.flavor) for order in lruOrders], lruMenu.statistics() # iterating neither counts nor recreates Cappuccino
+
+columnarShop = ColumnarCoffeeShop()
+columnarShop.takeOrders([('Cappuccino', 2), ('Frappe', 1), ('Espresso', 1)])
+columnarShop.service()
+shop.serviceBatched()
+
+orders = [(['Cappuccino', 'Frappe', 'Espresso'][index % 3], index) for index in xrange(100000)]
+objectShop = CoffeeShop()
+for flavorName, tableNumber in orders:
+    objectShop.takeOrder(flavorName, tableNumber)
+columnarShop = ColumnarCoffeeShop()
+columnarShop.takeOrders(orders)
+objectBytes = sys.getsizeof(objectShop.orders) + sum(sys.getsizeof(order) + sys.getsizeof(order.tableNumber) for order in objectShop.orders)
+print 'Order objects: %s bytes, columns: %s bytes' % (objectBytes, columnarShop.orders.byteSize())
+
+
+import shutil
+import tempfile
+directory = tempfile.mkdtemp()
+try:
+    frozenMenu = FrozenMenu.freeze(shop.menu, os.path.join(directory, 'menu.bin'))
+    print frozenMenu.flavorId('Frappe'), frozenMenu.lookup('Frappe') is frozenMenu.lookupById(frozenMenu.flavorId('Frappe'))
+    frozenShop = CoffeeShop(frozenMenu)
+    frozenShop.takeOrder('Espresso', 4)
+    frozenShop.takeOrder('Frappe', 4)
+    frozenShop.service()
+    if __name__ == '__main__':
+        # a worker process (forked, or spawned and given the filename) resolves flavors against the same mapped table
+        worker = multiprocessing.Process(target=serveFromFrozenMenu, args=(frozenMenu, [('Espresso', 5), ('Cappuccino', 6)]))
+        worker.start()
+        worker.join()
+    frozenMenu.close()
+finally:
+    shutil.rmtree(directory)
+
+with open(os.devnull, 'w') as devnull:
+    print 'Orders served per second: %d' % columnarShop.serviceBatched(devnull)
+
+class CoffeeFlavorWithDict(object):
+    # the layout without __slots__: the fields live in a per-instance __dict__
+
+    def __init__(self, newFlavor):
+        self.name = newFlavor
+
+class OrderWithDict(object):
+
+    def __init__(self, tableNumber, flavor):
+        self.tableNumber = tableNumber
+        self.flavor = flavor
+
+flavor = columnarShop.menu.lookup('Frappe')
+print 'CoffeeFlavor with __dict__: %s' % measureFootprint(lambda index: CoffeeFlavorWithDict('Frappe'), 10 ** 6)
+print 'CoffeeFlavor with __slots__: %s' % measureFootprint(lambda index: CoffeeFlavor('Frappe'), 10 ** 6)
+print 'Order with __dict__: %s' % measureFootprint(lambda index: OrderWithDict(1, flavor), 10 ** 6)
+print 'Order with __slots__: %s' % measureFootprint(lambda index: Order(1, flavor), 10 ** 6)
@@ -3,12 +3,93 @@
 # - composite and indivisual nodes are treated uniformly
 # 
 
+import mmap
+import multiprocessing
+import operator
+import struct
+import threading
+from collections import OrderedDict
+
+try:
+    import numpy # optional: whole-column arithmetic for interpretBatch
+except ImportError:
+    numpy = None
+
+def columnOperation(operation, left, right):
+    # apply a binary operation to two columns (or a column and a scalar) element by element
+    if numpy is not None or not (isinstance(left, list) or isinstance(right, list)):
+        return operation(left, right)
+    if not isinstance(left, list):
+        left = [left] * len(right)
+    if not isinstance(right, list):
+        right = [right] * len(left)
+    return map(operation, left, right)
+
+class CyclicBindingException(Exception):
+    pass
+
+class Bindings(object):
+    # the variables of one evaluation: every variable is resolved at most once (memoized),
+    # and a variable whose binding refers back to itself is reported instead of recursing forever
+
+    def __init__(self, variables):
+        self.variables = variables
+        self.resolved = dict()
+        self.resolving = set()
+
+    def __contains__(self, name):
+        return name in self.variables
+
+    def __getitem__(self, name):
+        return self.variables[name]
+
+    def get(self, name, default=None):
+        return self.variables.get(name, default)
+
+    def items(self):
+        return self.variables.items()
+
+    def resolve(self, name):
+        if name in self.resolved:
+            return self.resolved[name]
+        if name in self.resolving:
+            raise CyclicBindingException('variable %s is bound to an expression depending on itself' % name)
+        self.resolving.add(name)
+        try:
+            value = self.variables[name].interpret(self)
+        finally:
+            self.resolving.discard(name)
+        self.resolved[name] = value
+        return value
+
+def tokenize(source, chunkSize=1 << 16):
+    # yield the whitespace separated tokens of a file object or an iterator of chunks,
+    # a token split across two chunks is carried over to the next one
+    chunks = source
+    if hasattr(source, 'read'):
+        chunks = iter(lambda: source.read(chunkSize), '')
+    partial = ''
+    for chunk in chunks:
+        tokens = (partial + chunk).split()
+        if chunk[-1:].isspace() or not tokens:
+            partial = ''
+        else:
+            partial = tokens.pop()
+        for token in tokens:
+            yield token
+    if partial:
+        yield partial
+
 class Expression(object):
     # an interface for all nodes of the syntax tree
 
     def interpret(self):
         raise NotImplementedError
 
+    def interpretBatch(self, columns):
+        # columns maps each variable name to a whole column of values
+        raise NotImplementedError
+
 class Number(Expression):
 
     def __init__(self, number):
@@ -17,6 +98,9 @@ class Number(Expression):
     def interpret(self, variables):
         return self.number
 
+    def interpretBatch(self, columns):
+        return self.number
+
 class Plus(Expression):
     # composite node, having left and right children
 
@@ -27,6 +111,9 @@ class Plus(Expression):
     def interpret(self, variables):
         return self.leftOperand.interpret(variables) + self.rightOperand.interpret(variables)
 
+    def interpretBatch(self, columns):
+        return columnOperation(operator.add, self.leftOperand.interpretBatch(columns), self.rightOperand.interpretBatch(columns))
+
 
 class Minus(Expression):
     # composite node, having left and right children
@@ -38,6 +125,9 @@ class Minus(Expression):
     def interpret(self, variables):
         return self.leftOperand.interpret(variables) - self.rightOperand.interpret(variables)
 
+    def interpretBatch(self, columns):
+        return columnOperation(operator.sub, self.leftOperand.interpretBatch(columns), self.rightOperand.interpretBatch(columns))
+
 class Variable(Expression):
     # indivisual node
 
@@ -47,14 +137,30 @@ class Variable(Expression):
     def interpret(self, variables):
         if self.name not in variables:
             return 0
-        return variables[self.name].interpret(variables)
+        if not isinstance(variables, Bindings):
+            variables = Bindings(variables)
+        return variables.resolve(self.name)
+
+    def interpretBatch(self, columns):
+        return columns.get(self.name, 0)
 
 class Parser(Expression):
     # create the syntax tree by parsing the expression string
 
     def __init__(self, expression):
+        self.build(expression.split(' '))
+
+    @classmethod
+    def fromStream(cls, source, chunkSize=1 << 16):
+        # parse a postfix program from a file object or an iterator of string chunks,
+        # tokens are produced lazily so the whole program text is never held in memory
+        parser = cls.__new__(cls)
+        parser.build(tokenize(source, chunkSize))
+        return parser
+
+    def build(self, tokens):
         expressionStack = []
-        for token in expression.split(' '):
+        for token in tokens:
             if token == '+':
                 subExpression = Plus(expressionStack.pop(), expressionStack.pop())
                 expressionStack.append(subExpression)
@@ -66,13 +172,616 @@ class Parser(Expression):
             else:
                 expressionStack.append(Variable(token))
         self.syntaxTree = expressionStack.pop()
+        self.evaluationOrder = None # set by optimize
+
+    @classmethod
+    def fromSyntaxTree(cls, syntaxTree):
+        # wrap an already built syntax tree without parsing again
+        parser = cls.__new__(cls)
+        parser.syntaxTree = syntaxTree
+        parser.evaluationOrder = None
+        return parser
 
     def interpret(self, context):
+        if not isinstance(context, Bindings):
+            context = Bindings(context) # shared by every Variable of this evaluation
+        if self.evaluationOrder is not None:
+            return self.interpretShared(context)
         return self.syntaxTree.interpret(context)
 
-sentence = Parser(expression='w x z - +')
-variables = dict() #a shared collection of Number objects
-variables['w'] = Number(5)
-variables['x'] = Number(10)
-variables['z'] = Number(42)
-print sentence.interpret(variables)
+    def optimize(self, constants=None):
+        # turn the syntax tree into a DAG: identical subtrees are replaced by one shared node
+        # (hash-consing), and subtrees whose leaves are all variables bound to Number objects in
+        # constants are folded into a single Number; returns how many nodes were removed
+        constants = constants or dict()
+        shared = dict() # structural key -> canonical node
+        canonical = dict() # id(original node) -> canonical node
+        originalCount = 0
+        pending = [(self.syntaxTree, False)]
+        while pending:
+            node, operandsDone = pending.pop()
+            if id(node) in canonical:
+                continue # a node already shared by an earlier optimize is counted once
+            if isinstance(node, (Plus, Minus)) and not operandsDone:
+                pending.append((node, True))
+                pending.append((node.rightOperand, False))
+                pending.append((node.leftOperand, False))
+                continue
+            originalCount += 1
+            if isinstance(node, (Plus, Minus)):
+                left = canonical[id(node.leftOperand)]
+                right = canonical[id(node.rightOperand)]
+                if isinstance(left, Number) and isinstance(right, Number):
+                    operation = operator.add if isinstance(node, Plus) else operator.sub
+                    candidate = Number(operation(left.number, right.number))
+                else:
+                    candidate = type(node)(left, right)
+                    key = (type(node), id(left), id(right))
+            elif isinstance(node, Variable) and isinstance(constants.get(node.name), Number):
+                candidate = Number(constants[node.name].number)
+            elif isinstance(node, Variable):
+                candidate = node
+                key = (Variable, node.name)
+            else:
+                candidate = node
+                key = (Expression, id(node))
+            if isinstance(candidate, Number):
+                key = (Number, type(candidate.number), candidate.number)
+            canonical[id(node)] = shared.setdefault(key, candidate)
+        self.syntaxTree = canonical[id(self.syntaxTree)]
+        # each shared node appears once in the evaluation order, operands before their operation
+        self.evaluationOrder = []
+        visited = set()
+        pending = [(self.syntaxTree, False)]
+        while pending:
+            node, operandsDone = pending.pop()
+            if id(node) in visited:
+                continue
+            if isinstance(node, (Plus, Minus)) and not operandsDone:
+                pending.append((node, True))
+                pending.append((node.rightOperand, False))
+                pending.append((node.leftOperand, False))
+                continue
+            visited.add(id(node))
+            self.evaluationOrder.append(node)
+        return originalCount - len(self.evaluationOrder)
+
+    def interpretShared(self, context):
+        # evaluate the optimized DAG, computing every shared node only once per call
+        values = dict()
+        for node in self.evaluationOrder:
+            if isinstance(node, Plus):
+                values[id(node)] = values[id(node.leftOperand)] + values[id(node.rightOperand)]
+            elif isinstance(node, Minus):
+                values[id(node)] = values[id(node.leftOperand)] - values[id(node.rightOperand)]
+            else:
+                values[id(node)] = node.interpret(context)
+        return values[id(self.syntaxTree)]
+
+    def interpretIteratively(self, context):
+        # same result as interpret, but walks the tree in postorder with an explicit stack
+        # instead of the python call stack, so arbitrarily deep trees do not hit RecursionError
+        # like Bindings.resolve, each variable is resolved once and a cyclic binding is reported
+        values = []
+        resolved = dict()
+        resolving = set()
+        pending = [self.syntaxTree]
+        while pending:
+            node = pending.pop()
+            if isinstance(node, (Plus, Minus)):
+                # the operation runs after both operands, left operand evaluated first
+                pending.append(operator.add if isinstance(node, Plus) else operator.sub)
+                pending.append(node.rightOperand)
+                pending.append(node.leftOperand)
+            elif isinstance(node, Variable):
+                if node.name not in context:
+                    values.append(0)
+                elif node.name in resolved:
+                    values.append(resolved[node.name])
+                elif node.name in resolving:
+                    raise CyclicBindingException('variable %s is bound to an expression depending on itself' % node.name)
+                else:
+                    # the marker records the value once the binding has been evaluated
+                    resolving.add(node.name)
+                    pending.append(('resolved', node.name))
+                    pending.append(context[node.name])
+            elif isinstance(node, Number):
+                values.append(node.number)
+            elif isinstance(node, Parser):
+                pending.append(node.syntaxTree)
+            elif isinstance(node, Expression):
+                values.append(node.interpret(context))
+            elif isinstance(node, tuple):
+                name = node[1]
+                resolved[name] = values[-1]
+                resolving.discard(name)
+            else:
+                right = values.pop()
+                left = values.pop()
+                values.append(node(left, right))
+        return values.pop()
+
+    def interpretBatch(self, columns):
+        # evaluate the expression once for a whole table of rows: each variable is bound to a column
+        # (a numpy array, or any sequence / buffer-protocol object such as array.array)
+        # and the result is a column, computed by whole-array operations when numpy is available
+        if numpy is not None:
+            columns = dict((name, numpy.asarray(column)) for name, column in columns.items())
+        else:
+            columns = dict((name, list(column)) for name, column in columns.items())
+        lengths = dict((name, len(column)) for name, column in columns.items() if numpy is None or column.ndim)
+        if len(set(lengths.values())) > 1:
+            raise ValueError('columns of different lengths: %s' % ', '.join('%s has %s' % item for item in sorted(lengths.items())))
+        return self.syntaxTree.interpretBatch(columns)
+
+    def compile(self):
+        # flatten the syntax tree into one python function, so that evaluating it no longer
+        # pays a method call per node (the variables are still interpreted as before)
+        return CompiledExpression(self.syntaxTree)
+
+class ParserCache(object):
+    # a bounded, thread-safe LRU cache of syntax trees keyed by the expression string
+    # the cached trees are shared and never modified (optimize builds new nodes),
+    # each parse returns its own Parser wrapping the shared tree
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.syntaxTrees = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def parse(self, expression):
+        with self.lock:
+            syntaxTree = self.syntaxTrees.pop(expression, None)
+            if syntaxTree is not None:
+                self.hits += 1
+                self.syntaxTrees[expression] = syntaxTree # most recently used goes last
+                return Parser.fromSyntaxTree(syntaxTree)
+            self.misses += 1
+        # parse outside the lock, two threads may parse the same string but only one tree is kept
+        syntaxTree = Parser(expression).syntaxTree
+        with self.lock:
+            syntaxTree = self.syntaxTrees.setdefault(expression, syntaxTree)
+            while len(self.syntaxTrees) > self.capacity:
+                self.syntaxTrees.popitem(last=False)
+                self.evictions += 1
+        return Parser.fromSyntaxTree(syntaxTree)
+
+    def prewarm(self, filename):
+        # parse every rule of a rules file (one expression per line, # for comments) ahead of time
+        with open(filename) as rules:
+            for line in rules:
+                expression = line.strip()
+                if expression and not expression.startswith('#'):
+                    self.parse(expression)
+
+    def statistics(self):
+        with self.lock:
+            return {'size': len(self.syntaxTrees), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+class IncrementalEvaluator(object):
+    # evaluates an expression once, caching the value of every node (including the nodes of
+    # the expressions bound to variables), then recomputes only the nodes downstream of a
+    # variable when its binding changes
+    # the expression and every bound expression are reference-counted roots, the nodes of a
+    # binding are forgotten as soon as nothing refers to them any more
+
+    def __init__(self, expression, variables):
+        self.expression = expression
+        self.variables = dict(variables)
+        self.nodes = dict() # id -> node, keeps every registered node alive
+        self.referenceCounts = dict() # id -> number of parents, bound names and roots of the node
+        self.parents = dict() # id -> nodes having it as an operand
+        self.references = dict() # variable name -> {id: Variable node with that name}
+        self.boundNames = dict() # id of a bound expression -> names bound to it
+        self.values = dict() # id -> cached value, missing when not computed yet
+        self.addReference(expression)
+        for name, value in self.variables.items():
+            self.bind(name, value)
+        self.result = self.evaluate()
+
+    def operands(self, node):
+        if isinstance(node, (Plus, Minus)):
+            return [node.leftOperand, node.rightOperand]
+        if isinstance(node, Parser):
+            return [node.syntaxTree]
+        if isinstance(node, Variable) and node.name in self.variables:
+            return [self.variables[node.name]]
+        return []
+
+    def addReference(self, root):
+        pending = [root]
+        while pending:
+            node = pending.pop()
+            self.referenceCounts[id(node)] = self.referenceCounts.get(id(node), 0) + 1
+            if id(node) in self.nodes:
+                continue
+            self.nodes[id(node)] = node
+            if isinstance(node, Variable):
+                # a Variable follows its binding through references, not through parents
+                self.references.setdefault(node.name, dict())[id(node)] = node
+                continue
+            for operand in self.operands(node):
+                self.parents.setdefault(id(operand), []).append(node)
+                pending.append(operand)
+
+    def removeReference(self, root):
+        pending = [root]
+        while pending:
+            node = pending.pop()
+            count = self.referenceCounts[id(node)] - 1
+            if count:
+                self.referenceCounts[id(node)] = count
+                continue
+            del self.referenceCounts[id(node)]
+            del self.nodes[id(node)]
+            self.values.pop(id(node), None)
+            if isinstance(node, Variable):
+                references = self.references[node.name]
+                del references[id(node)]
+                if not references:
+                    del self.references[node.name]
+                continue
+            for operand in self.operands(node):
+                parents = self.parents[id(operand)]
+                parents.remove(node)
+                if not parents:
+                    del self.parents[id(operand)]
+                pending.append(operand)
+
+    def bind(self, name, value):
+        self.variables[name] = value
+        self.boundNames.setdefault(id(value), set()).add(name)
+        self.addReference(value)
+
+    def unbind(self, name):
+        value = self.variables.pop(name)
+        names = self.boundNames[id(value)]
+        names.discard(name)
+        if not names:
+            del self.boundNames[id(value)]
+        self.removeReference(value)
+
+    def compute(self, node):
+        if isinstance(node, Plus):
+            return self.values[id(node.leftOperand)] + self.values[id(node.rightOperand)]
+        if isinstance(node, Minus):
+            return self.values[id(node.leftOperand)] - self.values[id(node.rightOperand)]
+        if isinstance(node, Number):
+            return node.number
+        if isinstance(node, Parser):
+            return self.values[id(node.syntaxTree)]
+        if isinstance(node, Variable):
+            if node.name not in self.variables:
+                return 0
+            return self.values[id(self.variables[node.name])]
+        return node.interpret(self.variables)
+
+    def evaluate(self):
+        # postorder over the nodes without a cached value only
+        inProgress = set()
+        pending = [(self.expression, False)]
+        while pending:
+            node, operandsDone = pending.pop()
+            if operandsDone:
+                self.values[id(node)] = self.compute(node)
+                inProgress.discard(id(node))
+                continue
+            if id(node) in self.values:
+                continue
+            if id(node) in inProgress:
+                raise CyclicBindingException('cyclic variable binding')
+            inProgress.add(id(node))
+            pending.append((node, True))
+            for operand in self.operands(node):
+                if id(operand) not in self.values:
+                    pending.append((operand, False))
+        return self.values[id(self.expression)]
+
+    def invalidate(self, name):
+        # forget the values of every node depending on the variable
+        invalidated = set()
+        pending = list(self.references.get(name, dict()).values())
+        while pending:
+            node = pending.pop()
+            if id(node) in invalidated:
+                continue
+            invalidated.add(id(node))
+            self.values.pop(id(node), None)
+            pending.extend(self.parents.get(id(node), []))
+            for boundName in self.boundNames.get(id(node), ()):
+                pending.extend(self.references.get(boundName, dict()).values())
+
+    def update(self, name, value):
+        # rebind one variable and return the new result of the expression
+        # a binding making the variables cyclic is undone before the exception is raised
+        previous = self.variables.get(name)
+        if previous is not None:
+            self.unbind(name)
+        self.bind(name, value)
+        self.invalidate(name)
+        try:
+            self.result = self.evaluate()
+        except CyclicBindingException:
+            self.unbind(name)
+            if previous is not None:
+                self.bind(name, previous)
+            self.invalidate(name)
+            self.result = self.evaluate()
+            raise
+        return self.result
+
+class CompiledExpression(Expression):
+    # the whole syntax tree as a single python function, evaluated with the same interface
+    # the function is flat, one statement per node in postorder (t3 = t1 + t2), so that
+    # deep trees do not exceed the nesting limits of the python parser
+
+    def __init__(self, syntaxTree):
+        lines = ['def function(variables):']
+        namespace = dict()
+        temporaries = dict() # id(node) -> name of the temporary holding its value
+        variableTemporaries = dict() # variable name -> temporary, each variable is resolved once
+        pending = [(syntaxTree, False)]
+        while pending:
+            node, operandsDone = pending.pop()
+            if id(node) in temporaries:
+                continue
+            if isinstance(node, (Plus, Minus)) and not operandsDone:
+                pending.append((node, True))
+                pending.append((node.rightOperand, False))
+                pending.append((node.leftOperand, False))
+                continue
+            if isinstance(node, Variable) and node.name in variableTemporaries:
+                temporaries[id(node)] = variableTemporaries[node.name]
+                continue
+            temporary = 't%s' % len(temporaries)
+            if isinstance(node, (Plus, Minus)):
+                operation = '+' if isinstance(node, Plus) else '-'
+                lines.append('    %s = %s %s %s' % (temporary, temporaries[id(node.leftOperand)], operation, temporaries[id(node.rightOperand)]))
+            elif isinstance(node, Variable):
+                # keep the missing-variable-is-0 rule of interpret
+                lines.append('    %s = variables[%r].interpret(variables) if %r in variables else 0' % (temporary, node.name, node.name))
+                variableTemporaries[node.name] = temporary
+            elif isinstance(node, Number):
+                # constants are passed in the namespace, repr of inf or nan is not valid source
+                namespace['c' + temporary] = node.number
+                lines.append('    %s = c%s' % (temporary, temporary))
+            else:
+                namespace['c' + temporary] = node
+                lines.append('    %s = c%s.interpret(variables)' % (temporary, temporary))
+            temporaries[id(node)] = temporary
+        lines.append('    return %s' % temporaries[id(syntaxTree)])
+        self.source = '\n'.join(lines)
+        exec compile(self.source, '<interpreter>', 'exec') in namespace
+        self.function = namespace['function']
+
+    def interpret(self, variables):
+        return self.function(variables)
+
+class FlatExpression(Expression):
+    # a syntax tree flattened into an array of fixed size instructions (opcode, left, right)
+    # in postorder, with a table of variable names; the evaluator runs directly against the
+    # buffer, which can be a memory-mapped file, so loading does not copy or rebuild objects
+    # - VARIABLE: left is the index into the name table
+    # - INTEGER / FLOAT: left holds the value (the bits of the double for FLOAT)
+    # - PLUS / MINUS: left and right are the indices of earlier instructions
+
+    VARIABLE, INTEGER, FLOAT, PLUS, MINUS = range(5)
+    header = struct.Struct('<4sxxxxqqq') # magic, number of instructions, root, size of the name table
+    instruction = struct.Struct('<qqq')
+    magic = 'EXP1'
+
+    def __init__(self, buffer):
+        magic, self.count, self.root, namesSize = self.header.unpack_from(buffer, 0)
+        if magic != self.magic:
+            raise ValueError('not a flat expression')
+        self.buffer = buffer
+        namesOffset = self.header.size + self.count * self.instruction.size
+        self.names = buffer[namesOffset:namesOffset + namesSize].split('\n')
+
+    @classmethod
+    def fromSyntaxTree(cls, syntaxTree):
+        # shared nodes (see Parser.optimize) are encoded once
+        instructions = []
+        names = []
+        nameIndex = dict()
+        index = dict() # id(node) -> instruction index
+        pending = [(syntaxTree, False)]
+        while pending:
+            node, operandsDone = pending.pop()
+            if id(node) in index:
+                continue
+            if isinstance(node, (Plus, Minus)) and not operandsDone:
+                pending.append((node, True))
+                pending.append((node.rightOperand, False))
+                pending.append((node.leftOperand, False))
+                continue
+            if isinstance(node, Plus):
+                instructions.append((cls.PLUS, index[id(node.leftOperand)], index[id(node.rightOperand)]))
+            elif isinstance(node, Minus):
+                instructions.append((cls.MINUS, index[id(node.leftOperand)], index[id(node.rightOperand)]))
+            elif isinstance(node, Variable):
+                if node.name not in nameIndex:
+                    nameIndex[node.name] = len(names)
+                    names.append(node.name)
+                instructions.append((cls.VARIABLE, nameIndex[node.name], 0))
+            elif isinstance(node, Number) and isinstance(node.number, float):
+                instructions.append((cls.FLOAT, struct.unpack('<q', struct.pack('<d', node.number))[0], 0))
+            elif isinstance(node, Number) and isinstance(node.number, (int, long)):
+                if not -2 ** 63 <= node.number < 2 ** 63:
+                    raise ValueError('cannot flatten %r, it does not fit in 64 bits' % node.number)
+                instructions.append((cls.INTEGER, node.number, 0))
+            else:
+                raise ValueError('cannot flatten %r' % node)
+            index[id(node)] = len(instructions) - 1
+        nameTable = '\n'.join(names)
+        parts = [cls.header.pack(cls.magic, len(instructions), index[id(syntaxTree)], len(nameTable))]
+        parts.extend(cls.instruction.pack(*instruction) for instruction in instructions)
+        parts.append(nameTable)
+        return cls(''.join(parts))
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.buffer[:])
+
+    def close(self):
+        # unmaps the file of a loaded expression (a flattened one has nothing to release)
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+    def interpret(self, variables):
+        if not isinstance(variables, Bindings):
+            variables = Bindings(variables)
+        values = [None] * self.count
+        unpack = self.instruction.unpack_from
+        buffer = self.buffer
+        offset = self.header.size
+        for position in xrange(self.count):
+            opcode, left, right = unpack(buffer, offset)
+            offset += self.instruction.size
+            if opcode == self.PLUS:
+                values[position] = values[left] + values[right]
+            elif opcode == self.MINUS:
+                values[position] = values[left] - values[right]
+            elif opcode == self.VARIABLE:
+                name = self.names[left]
+                values[position] = variables.resolve(name) if name in variables else 0
+            elif opcode == self.INTEGER:
+                values[position] = left
+            else:
+                values[position] = struct.unpack('<d', struct.pack('<q', left))[0]
+        return values[self.root]
+
+# state of a worker process of interpretInParallel: the bindings are received once, when the
+# worker starts, instead of being pickled again with every shard of expressions
+workerVariables = None
+workerCache = None
+
+def initializeWorker(variables):
+    global workerVariables, workerCache
+    workerVariables = variables
+    workerCache = ParserCache()
+
+def interpretShard(expressions):
+    return [workerCache.parse(expression).interpret(workerVariables) for expression in expressions]
+
+def interpretInParallel(expressions, variables, processes=None, shardSize=256):
+    # evaluate many independent expression strings against the same bindings on a process pool,
+    # results are returned in the order of the expressions
+    shards = [expressions[start:start + shardSize] for start in range(0, len(expressions), shardSize)]
+    pool = multiprocessing.Pool(processes, initializeWorker, (variables,))
+    try:
+        results = pool.map(interpretShard, shards)
+    finally:
+        pool.close()
+        pool.join()
+    return [result for shard in results for result in shard]
+
+if __name__ == '__main__': # spawned pool workers import this module again, without the demo
+    sentence = Parser(expression='w x z - +')
+    variables = dict() #a shared collection of Number objects
+    variables['w'] = Number(5)
+    variables['x'] = Number(10)
+    variables['z'] = Number(42)
+    print sentence.interpret(variables)
+
+    compiled = sentence.compile()
+    print compiled.interpret(variables)
+    print compiled.interpret(dict()) # missing variables are still 0
+
+    print sentence.interpretIteratively(variables)
+    deepSentence = Parser(expression='w' + ' x +' * 100000) # too deep for the recursive interpret
+    print deepSentence.interpretIteratively(variables)
+    # interpretIteratively agrees with interpret on random sentences over numbers, nested Parser
+    # bindings (d uses c, which uses a and b), a Parser shared by two names (c and e) and a missing name f
+    import random
+    random.seed(0)
+    shared = Parser(expression='a b -')
+    context = {'a': Number(3), 'b': Number(-7), 'c': shared, 'd': Parser(expression='c a + c -'), 'e': shared}
+    for _ in range(200):
+        tokens = []
+        depth = 0 # operands on the stack of the postfix sentence
+        for _ in range(random.randint(1, 40)):
+            if depth >= 2 and random.random() < 0.4:
+                tokens.append(random.choice('+-'))
+                depth -= 1
+            else:
+                tokens.append(random.choice('abcdef'))
+                depth += 1
+        tokens += [random.choice('+-') for _ in range(depth - 1)]
+        randomSentence = Parser(expression=' '.join(tokens))
+        assert randomSentence.interpretIteratively(context) == randomSentence.interpret(context), tokens
+
+    repeated = Parser(expression='w x + w x + - w x + + z +')
+    print repeated.interpret(variables)
+    print repeated.optimize() # the repeated w x + subterms become one shared node
+    print repeated.interpret(variables)
+    print repeated.optimize(constants={'w': Number(5), 'x': Number(10)}) # w x + folds into 15
+    print repeated.interpret(variables)
+
+    cache = ParserCache(capacity=2)
+    for expression in ['w x z - +', 'w x +', 'w x z - +', 'x z -', 'w x +']:
+        print cache.parse(expression).interpret(variables)
+    print cache.statistics()
+
+    dashboard = IncrementalEvaluator(Parser(expression='w y + y +'), {'w': Number(5), 'x': Number(10), 'y': Parser(expression='w x -')})
+    print dashboard.result
+    print dashboard.update('x', Number(1)) # only y and the nodes above it are recomputed
+    print dashboard.update('w', Number(0))
+
+    print Parser.fromStream(iter(['w x', ' z', ' -', ' +'])).interpret(variables)
+
+    import os
+    import shutil
+    import tempfile
+    flat = FlatExpression.fromSyntaxTree(sentence.syntaxTree)
+    directory = tempfile.mkdtemp()
+    try:
+        flatFilename = os.path.join(directory, 'sentence.expr')
+        flat.save(flatFilename)
+        loaded = FlatExpression.load(flatFilename)
+        print loaded.interpret(variables)
+        loaded.close()
+    finally:
+        shutil.rmtree(directory)
+    try:
+        FlatExpression.fromSyntaxTree(Number(2 ** 70))
+    except ValueError as e:
+        print e
+
+    heavy = Parser(expression='w x z - +')
+    for level in range(30):
+        variables['level%s' % level] = heavy
+        heavy = Parser(expression='level%s level%s +' % (level, level)) # linear, not 2 ** 30 evaluations
+    print heavy.interpret(variables)
+    try:
+        Parser(expression='a').interpret({'a': Parser(expression='b w +'), 'b': Parser(expression='a')})
+    except CyclicBindingException as e:
+        print e
+
+    from array import array
+    print sentence.interpretBatch({'w': array('d', [5, 1]), 'x': array('d', [10, 2]), 'z': [42, 3]})
+    try:
+        sentence.interpretBatch({'w': [5, 1], 'x': [10], 'z': [42, 3]})
+    except ValueError as e:
+        print e
+
+    import timeit
+    rule = Parser(expression='a b + c - d + e - f + g - h + a - b +')
+    bindings = dict((name, Number(index)) for index, name in enumerate('abcdefgh'))
+    compiledRule = rule.compile()
+    print 'tree walking: %.3fs' % timeit.timeit(lambda: rule.interpret(bindings), number=20000)
+    print 'compiled:     %.3fs' % timeit.timeit(lambda: compiledRule.interpret(bindings), number=20000)
+
+    # distinct rule strings (each ends with its own unbound variable), so every worker parses every rule
+    body = ' '.join(['a'] + ['%s %s' % (name, '+-'[index % 2]) for index, name in enumerate('bcdefgh' * 40)])
+    rules = ['%s unbound%s +' % (body, index) for index in range(4000)]
+    for processes in sorted(set([1, 2, multiprocessing.cpu_count()])):
+        print '%s processes: %.3fs' % (processes, timeit.timeit(lambda: interpretInParallel(rules, bindings, processes), number=1))
@@ -3,11 +3,83 @@
 # used when creating an instance is too expensive (use clone instead)
 
 import copy
+import mmap
+import multiprocessing
+import os
+import sys
+import threading
+from array import array
+from collections import OrderedDict
+
+class CopyOnWriteList(object):
+    # a list that clones share until one of them writes to it, the writer then gets its own copy
+    # no reference count is kept: once a list has been shared, every handle (the original too)
+    # copies it on its first write, so no count can be lost between threads
+
+    def __init__(self, items=()):
+        self.items = list(items)
+        self.owned = True # False while the items may be shared with other handles
+
+    def __copy__(self):
+        self.owned = False
+        other = CopyOnWriteList.__new__(CopyOnWriteList)
+        other.items = self.items
+        other.owned = False
+        return other
+
+    def writable(self):
+        if not self.owned:
+            self.items = list(self.items)
+            self.owned = True
+        return self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __eq__(self, other):
+        if isinstance(other, CopyOnWriteList):
+            other = other.items
+        return self.items == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self.items)
+
+    def __setitem__(self, index, value):
+        self.writable()[index] = value
+
+    def __delitem__(self, index):
+        del self.writable()[index]
+
+    def append(self, value):
+        self.writable().append(value)
+
+    def extend(self, values):
+        self.writable().extend(values)
+
+    def insert(self, index, value):
+        self.writable().insert(index, value)
+
+    def pop(self, index=-1):
+        return self.writable().pop(index)
 
 class Prototype(object):
 
     def clone(self):
-        raise NotImplementedError
+        # member-wise copy, copy-on-write members get their own handle on the shared items
+        other = copy.copy(self)
+        for name, value in vars(self).items():
+            if isinstance(value, CopyOnWriteList):
+                setattr(other, name, copy.copy(value))
+        return other
 
 class WordOccurrences(Prototype):
     # the field list: occurrences contains the position of the keyword in the text
@@ -15,25 +87,284 @@ class WordOccurrences(Prototype):
     # that directly clones the result from an existing instance if any
 
     def __init__(self, test, word):
-        self.occurrences = []
-        for index in range(len(test)):
-            if test[index:].startswith(word):
-                self.occurrences.append(index)
+        # clones share the occurrences until one of them modifies its own
+        self.occurrences = CopyOnWriteList()
+        self.word = word
+        self.length = 0 # length of the text scanned so far
+        self.tail = '' # its last len(word) - 1 characters, where a match may still begin
+        self.append(test)
+
+    def append(self, moreText):
+        # scan only the appended text, plus the tail of the previous text for a match across both
+        # str.find scans from the previous match without copying suffixes of the text
+        # (overlapping occurrences are kept, as with checking startswith at every index)
+        window = self.tail + moreText
+        offset = self.length - len(self.tail)
+        occurrences = []
+        index = window.find(self.word)
+        while 0 <= index < len(window):
+            occurrences.append(offset + index)
+            index = window.find(self.word, index + 1)
+        self.occurrences.extend(occurrences)
+        self.length += len(moreText)
+        self.tail = window[max(0, len(window) - len(self.word) + 1):] if len(self.word) > 1 else ''
 
     def getOneOccurrence(self, n):
         if n < len(self.occurrences):
             return self.occurrences[n]
 
-    def clone(self):
-        # return the member-wise copy of the object itself
-        return copy.copy(self)
-
-searchEngine = WordOccurrences('This is a test.', 'is')
-anotherSearchEngine = searchEngine.clone()
-print anotherSearchEngine.getOneOccurrence(0)
-print anotherSearchEngine.getOneOccurrence(1)
-print anotherSearchEngine.getOneOccurrence(2)
-yetanotherSearchEngine = searchEngine.clone()
-print yetanotherSearchEngine.getOneOccurrence(0)
-print yetanotherSearchEngine.getOneOccurrence(1)
-print yetanotherSearchEngine.getOneOccurrence(2)
+class SuffixArray(object):
+    # sorted start positions of all suffixes of a text, built once and only read afterwards
+    # built in pure python in O(n log^2 n): practical up to a few hundred KB of text
+    # (roughly a second per 100 KB), larger corpora need a C implementation of the construction
+
+    def __init__(self, text):
+        # prefix doubling: sort by the rank of the first k characters, then of the first 2k
+        self.text = text
+        n = len(text)
+        positions = range(n)
+        rank = [ord(character) for character in text]
+        k = 1
+        while n:
+            # one integer key per position and round, combining the ranks at position and position + k
+            width = max(rank) + 2
+            keys = [rank[position] * width + (rank[position + k] + 1 if position + k < n else 0) for position in xrange(n)]
+            positions.sort(key=keys.__getitem__)
+            newRank = [0] * n
+            for previous, position in zip(positions, positions[1:]):
+                newRank[position] = newRank[previous] + (keys[position] != keys[previous])
+            rank = newRank
+            if rank[positions[-1]] == n - 1: # all ranks distinct, the order is final
+                break
+            k *= 2
+        self.positions = array('i', positions)
+
+    def bound(self, word, strict):
+        # index of the first suffix whose prefix is >= word (> word when strict)
+        low, high = 0, len(self.positions)
+        while low < high:
+            middle = (low + high) // 2
+            start = self.positions[middle]
+            prefix = self.text[start:start + len(word)]
+            if prefix < word or (strict and prefix == word):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, word):
+        # start positions of every occurrence of word, in text order
+        return sorted(self.positions[self.bound(word, False):self.bound(word, True)])
+
+class IndexedWordOccurrences(Prototype):
+    # the expensive part, the suffix array of the text, is built once and shared read-only
+    # by all clones, so a clone can look up a different word in O(m log n)
+
+    def __init__(self, text, word, index=None):
+        self.index = index or SuffixArray(text)
+        self.occurrences = CopyOnWriteList(self.index.find(word))
+
+    def getOneOccurrence(self, n):
+        if n < len(self.occurrences):
+            return self.occurrences[n]
+
+    def cloneForWord(self, word):
+        # a clone answering another word from the same index
+        return IndexedWordOccurrences(self.index.text, word, self.index)
+
+class OccurrenceScan(object):
+    # the occurrences of a word found so far, extended only as far as somebody asks
+    # offsets are kept in an array of C longs rather than a list of int objects
+
+    def __init__(self, text, word):
+        self.text = text
+        self.word = word
+        self.found = array('l')
+        self.nextStart = 0
+        self.finished = False
+        self.lock = threading.Lock() # clones used from several threads share the scan
+
+    def extendTo(self, n):
+        # find occurrences until the n-th one (counting from 0) is known or the text ends
+        with self.lock:
+            while len(self.found) <= n and not self.finished:
+                index = self.text.find(self.word, self.nextStart)
+                if 0 <= index < len(self.text):
+                    self.found.append(index)
+                    self.nextStart = index + 1
+                else:
+                    self.finished = True
+
+    def snapshot(self):
+        # every occurrence, scanning the rest of the text if needed
+        self.extendTo(len(self.text))
+        with self.lock:
+            return tuple(self.found)
+
+class LazyWordOccurrences(Prototype):
+    # construction is free, the text is only scanned up to the largest requested occurrence
+    # clones share the scan, so whatever one of them has found is reused by the others
+
+    def __init__(self, test, word):
+        self.scan = OccurrenceScan(test, word)
+
+    @property
+    def occurrences(self):
+        # a snapshot, the found offsets themselves are shared with the clones and only grow
+        return self.scan.snapshot()
+
+    def getOneOccurrence(self, n):
+        self.scan.extendTo(n)
+        with self.scan.lock:
+            if n < len(self.scan.found):
+                return self.scan.found[n]
+
+def findInChunk(arguments):
+    # occurrences of word starting in [start, end) of a memory-mapped file, the chunk is read
+    # len(word) - 1 bytes further so that a match straddling the chunk boundary is found
+    filename, word, start, end = arguments
+    occurrences = []
+    with open(filename, 'rb') as f:
+        text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            limit = min(end + len(word) - 1, len(text))
+            index = text.find(word, start, limit)
+            while 0 <= index < end:
+                occurrences.append(index)
+                index = text.find(word, index + 1, limit)
+        finally:
+            text.close()
+    return occurrences
+
+class FileWordOccurrences(Prototype):
+    # same occurrences as WordOccurrences, for a file that need not fit in memory: the file is
+    # memory-mapped and scanned in fixed-size chunks by a pool of processes
+
+    def __init__(self, filename, word, chunkSize=1 << 24, processes=None):
+        size = os.path.getsize(filename)
+        chunks = [(filename, word, start, min(start + chunkSize, size)) for start in range(0, size, chunkSize)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            # map keeps the chunks in order, so the offsets stay sorted
+            self.occurrences = CopyOnWriteList(index for chunk in pool.map(findInChunk, chunks) for index in chunk)
+        finally:
+            pool.close()
+            pool.join()
+
+    def getOneOccurrence(self, n):
+        if n < len(self.occurrences):
+            return self.occurrences[n]
+
+def estimateSize(prototype):
+    # rough number of bytes held by a prototype: the object and everything reachable from its
+    # fields (nested objects such as a SuffixArray, strings, arrays and the items of sequences),
+    # each object counted once
+    size = 0
+    seen = set()
+    pending = [prototype]
+    while pending:
+        value = pending.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        size += sys.getsizeof(value) # for a str or an array this includes its contents
+        if isinstance(value, (list, tuple, set, CopyOnWriteList)):
+            pending.extend(value)
+        elif isinstance(value, dict):
+            pending.extend(value.keys())
+            pending.extend(value.values())
+        elif hasattr(value, '__dict__') and not isinstance(value, type):
+            pending.append(vars(value))
+    return size
+
+class PrototypeRegistry(object):
+    # pre-built prototypes by key, handed out as clones; the least recently used prototypes
+    # are evicted when there are more than capacity of them or they exceed the memory budget
+
+    def __init__(self, capacity=None, memoryBudget=None, sizeOf=estimateSize):
+        self.capacity = capacity
+        self.memoryBudget = memoryBudget
+        self.sizeOf = sizeOf
+        self.prototypes = OrderedDict() # key -> (prototype, size)
+        self.memoryUsed = 0
+        self.lock = threading.Lock()
+
+    def register(self, key, prototype):
+        size = self.sizeOf(prototype)
+        with self.lock:
+            if key in self.prototypes:
+                self.memoryUsed -= self.prototypes.pop(key)[1]
+            self.prototypes[key] = (prototype, size)
+            self.memoryUsed += size
+            while self.prototypes and ((self.capacity is not None and len(self.prototypes) > self.capacity) or
+                                       (self.memoryBudget is not None and self.memoryUsed > self.memoryBudget)):
+                self.memoryUsed -= self.prototypes.popitem(last=False)[1][1]
+
+    def get(self, key, factory=None):
+        # a clone of the prototype registered under key, built with factory() if it is missing
+        with self.lock:
+            entry = self.prototypes.pop(key, None)
+            if entry is not None:
+                self.prototypes[key] = entry # most recently used goes last
+                return entry[0].clone()
+        if factory is None:
+            return None
+        prototype = factory()
+        self.register(key, prototype)
+        return prototype.clone()
+
+if __name__ == '__main__': # spawned pool workers import this module again, without the demo
+    searchEngine = WordOccurrences('This is a test.', 'is')
+    anotherSearchEngine = searchEngine.clone()
+    print anotherSearchEngine.getOneOccurrence(0)
+    print anotherSearchEngine.getOneOccurrence(1)
+    print anotherSearchEngine.getOneOccurrence(2)
+    yetanotherSearchEngine = searchEngine.clone()
+    print yetanotherSearchEngine.getOneOccurrence(0)
+    print yetanotherSearchEngine.getOneOccurrence(1)
+    print yetanotherSearchEngine.getOneOccurrence(2)
+
+    indexedSearchEngine = IndexedWordOccurrences('This is a test.', 'is')
+    print indexedSearchEngine.getOneOccurrence(1)
+    print indexedSearchEngine.cloneForWord('t').getOneOccurrence(1)
+
+    ownSearchEngine = searchEngine.clone()
+    ownSearchEngine.occurrences.append(14) # copied on this write, the prototype is untouched
+    print ownSearchEngine.occurrences, searchEngine.occurrences
+
+    growingSearchEngine = searchEngine.clone()
+    growingSearchEngine.append(' It is appended.') # only the new text is scanned
+    print growingSearchEngine.occurrences, searchEngine.occurrences
+
+    registry = PrototypeRegistry(capacity=2, memoryBudget=1 << 20)
+    registry.register('is', searchEngine)
+    print registry.get('is').getOneOccurrence(1)
+    print registry.get('test', lambda: WordOccurrences('This is a test.', 'test')).getOneOccurrence(0)
+
+    lazySearchEngine = LazyWordOccurrences('This is a test.', 'is')
+    print lazySearchEngine.getOneOccurrence(0) # only the first occurrence has been searched for
+    print lazySearchEngine.clone().getOneOccurrence(1)
+    print lazySearchEngine.occurrences
+
+    import shutil
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+        textFilename = os.path.join(directory, 'text.txt')
+        with open(textFilename, 'wb') as f:
+            f.write('This is a test.')
+        fileSearchEngine = FileWordOccurrences(textFilename, 'is', chunkSize=3) # 'is' straddles a chunk boundary
+        print fileSearchEngine.getOneOccurrence(0)
+        print fileSearchEngine.getOneOccurrence(1)
+    finally:
+        shutil.rmtree(directory)
+
+    import timeit
+    text = 'This is a test. ' * 2000
+    print 'startswith at every index: %.3fs' % timeit.timeit(lambda: [index for index in range(len(text)) if text[index:].startswith('is')], number=1)
+    print 'find loop:                 %.3fs' % timeit.timeit(lambda: WordOccurrences(text, 'is'), number=1)
+    print 'find loop on %s MB:         %.3fs' % (len(text * 100) >> 20, timeit.timeit(lambda: WordOccurrences(text * 100, 'is'), number=1))
+    indexed = IndexedWordOccurrences(text, 'is')
+    print 'suffix array on %s KB:     %.3fs' % (len(text) >> 10, timeit.timeit(lambda: IndexedWordOccurrences(text, 'is'), number=1))
+    print 'lookup of a new word:      %.3fs' % timeit.timeit(lambda: indexed.cloneForWord('test').getOneOccurrence(0), number=1)
+    print 'first of a lazy scan:      %.6fs' % timeit.timeit(lambda: LazyWordOccurrences(text * 100, 'is').getOneOccurrence(0), number=1)
@@ -2,6 +2,17 @@
 # object pattern: relationships between objects are established at run time via composition
 # structural pattern: composes classes or objects into larger structures
 
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import timeit
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
 class Image(object):
     # both proxy and real objects implement the same interface
 
@@ -15,27 +26,207 @@ class RealImage(Image):
         self.loadImageFromDisk()
 
     def loadImageFromDisk(self):
+        # the file is memory-mapped rather than read: nothing is copied, and the OS reads
+        # each page of pixels in when it is first accessed
         print 'Loading %s' % self.filename
+        with open(self.filename, 'rb') as f:
+            self.sizeInBytes = os.fstat(f.fileno()).st_size
+            self.pixels = ''
+            if self.sizeInBytes: # an empty file cannot be mapped
+                self.pixels = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def view(self, offset=0, size=None):
+        # a read-only slice of the pixels sharing their memory (a crop that does not copy)
+        if size is None:
+            return buffer(self.pixels, offset)
+        return buffer(self.pixels, offset, size)
 
     def displayImage(self):
         print 'Displaying %s' % self.filename
 
+class PlaceholderImage(RealImage):
+    # an image with no file behind it, for names that only stand for a picture
+
+    def loadImageFromDisk(self):
+        print 'Loading %s' % self.filename
+        self.sizeInBytes = 0
+        self.pixels = ''
+
+class PendingLoad(object):
+    # a load started in the background, waited on by whoever needs the image before it is done
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.image = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.image
+
+class ImageCache(object):
+    # the loaded real images shared by all proxies, the least recently displayed ones are dropped
+    # when their total size exceeds the budget and are loaded again by the next proxy needing them
+    # images can be prefetched on a pool of background threads
+
+    def __init__(self, budgetInBytes=256 << 20, prefetchThreads=4, imageClass=RealImage):
+        self.budgetInBytes = budgetInBytes
+        self.imageClass = imageClass
+        self.images = OrderedDict() # filename -> RealImage, least recently used first
+        self.loading = dict() # filename -> PendingLoad
+        self.residentBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.prefetchThreads = prefetchThreads
+        self.pool = None # started with the first prefetch
+
+    def get(self, filename):
+        loader = False
+        with self.lock:
+            image = self.images.pop(filename, None)
+            if image is not None:
+                self.hits += 1
+                self.images[filename] = image
+                return image
+            pending = self.loading.get(filename)
+            if pending is not None:
+                self.hits += 1
+            else:
+                # single flight: callers arriving while this load runs wait for it
+                self.misses += 1
+                pending = self.loading[filename] = PendingLoad()
+                loader = True
+        if loader:
+            self.load(filename, pending)
+        return pending.wait() # loaded by this call, by another caller or by a prefetch
+
+    def store(self, filename, image):
+        with self.lock:
+            if filename not in self.images:
+                self.residentBytes += image.sizeInBytes
+            else:
+                self.residentBytes += image.sizeInBytes - self.images.pop(filename).sizeInBytes
+            self.images[filename] = image
+            while self.residentBytes > self.budgetInBytes and len(self.images) > 1:
+                self.residentBytes -= self.images.popitem(last=False)[1].sizeInBytes
+
+    def prefetch(self, filename):
+        # start loading the image in the background unless it is loaded or being loaded already
+        with self.lock:
+            if filename in self.images or filename in self.loading:
+                return
+            pending = self.loading[filename] = PendingLoad()
+            if self.pool is None:
+                self.pool = ThreadPool(self.prefetchThreads)
+        self.pool.apply_async(self.load, (filename, pending))
+
+    def load(self, filename, pending):
+        try:
+            pending.image = self.imageClass(filename)
+            self.store(filename, pending.image)
+        except Exception as e:
+            pending.error = e
+        finally:
+            with self.lock:
+                del self.loading[filename]
+            pending.done.set()
+
+    def hitRatio(self):
+        with self.lock:
+            return float(self.hits) / max(self.hits + self.misses, 1)
+
 class ProxyImage(Image):
     # virtual proxy, in place of expensive objects
+    # the real image is kept in a cache shared by all proxies instead of by the proxy itself
 
-    def __init__(self, filename):
+    cache = ImageCache()
+
+    def __init__(self, filename, cache=None):
         self.filename = filename
-        self.image = None
+        if cache is not None:
+            self.cache = cache
+
+    def prefetch(self):
+        # a hint that the image will be displayed soon, so it is loaded in the background
+        self.cache.prefetch(self.filename)
 
     def displayImage(self):
-        if self.image is None:
-            self.image = RealImage(self.filename)
-        self.image.displayImage()
+        self.cache.get(self.filename).displayImage()
 
-image1 = ProxyImage('Photo1')
-image2 = ProxyImage('Photo2')
+placeholders = ImageCache(imageClass=PlaceholderImage) # the photos of this demo are not real files
+image1 = ProxyImage('Photo1', placeholders)
+image2 = ProxyImage('Photo2', placeholders)
 image1.displayImage()
 image1.displayImage()
 image2.displayImage()
 image2.displayImage()
 image1.displayImage()
+
+directory = tempfile.mkdtemp()
+try:
+    for name in ['Photo3', 'Photo4']:
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write('\0' * 1024)
+    gallery = ImageCache(budgetInBytes=1024) # room for one of the photos only
+    image3 = ProxyImage(os.path.join(directory, 'Photo3'), gallery)
+    image4 = ProxyImage(os.path.join(directory, 'Photo4'), gallery)
+    image3.displayImage()
+    image3.displayImage()
+    image4.displayImage() # Photo3 is evicted
+    image3.displayImage() # and loaded again
+    print gallery.hitRatio(), gallery.residentBytes
+finally:
+    shutil.rmtree(directory)
+
+image5 = ProxyImage('Photo5', placeholders)
+image5.prefetch() # loaded on a background thread
+image5.displayImage() # waits for that load instead of starting another one
+
+class SlowPlaceholderImage(PlaceholderImage):
+    # counts its loads per filename, and each load takes a while, so that concurrent displays
+    # of an image overlap with its load
+
+    loads = dict()
+    loadsLock = threading.Lock()
+
+    def loadImageFromDisk(self):
+        with self.loadsLock:
+            self.loads[self.filename] = self.loads.get(self.filename, 0) + 1
+        time.sleep(0.05)
+        super(SlowPlaceholderImage, self).loadImageFromDisk()
+
+stressCache = ImageCache(imageClass=SlowPlaceholderImage)
+stressImages = [ProxyImage('Stress%s' % index, stressCache) for index in range(16)]
+pool = ThreadPool(64)
+stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+try:
+    pool.map(lambda image: image.displayImage(), stressImages * 64)
+finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+    pool.close()
+assert SlowPlaceholderImage.loads == dict((image.filename, 1) for image in stressImages), SlowPlaceholderImage.loads
+assert stressCache.misses == len(stressImages)
+print 'loads for %s proxies displayed by 64 threads: %s' % (len(stressImages), stressCache.misses)
+
+directory = tempfile.mkdtemp()
+try:
+    largeFilename = os.path.join(directory, 'Large')
+    with open(largeFilename, 'wb') as f:
+        f.truncate(64 << 20)
+    def readWholeFile():
+        with open(largeFilename, 'rb') as f:
+            return f.read()[:4096]
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        readTime = timeit.timeit(readWholeFile, number=1)
+        mappedTime = timeit.timeit(lambda: str(RealImage(largeFilename).view(0, 4096)), number=1)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    print 'first 4 KB of a 64 MB image: read %.3fs, mmap %.3fs' % (readTime, mappedTime)
+finally:
+    shutil.rmtree(directory)